@@ -18,4 +18,5 @@
 import warnings
 
 from .nvtx.nvmarker import init
+from .nvtx.nvmarker import enable, disable
 from .nvtx.nvmarker import add_wrapper as wrap
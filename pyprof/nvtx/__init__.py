@@ -16,4 +16,5 @@
 # limitations under the License.
 
 from .nvmarker import init
+from .nvmarker import enable, disable
 from .nvmarker import add_wrapper as wrap
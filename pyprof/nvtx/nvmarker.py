@@ -21,7 +21,7 @@ This file intercepts (monkey patches) the following functions and adds NVTX mark
 	torch.nn.functional.*
 	torch.nn.*.forward
 
-The NVTX markers (one or more) contain the following information
+A single NVTX marker is pushed for every call. It contains the following information
 	call trace (a list of file_name:line_number)
 	extra_repr() from torch.nn modules
 	module/class name
@@ -37,24 +37,53 @@ import torch
 import torch.cuda.nvtx as nvtx
 import numpy
 import inspect as ins
-import traceback
+import types
+import functools
+import os
+import sys
 import math
 import json
 import importlib
+import warnings
+import weakref
+
+from ..parse.markers import traceBlocked
+
+# Call the NVTX bindings directly. torch.cuda.nvtx.range_push / range_pop
+# are Python functions that only forward to them.
+try:
+    from torch._C import _nvtx
+    range_push, range_pop = _nvtx.rangePushA, _nvtx.rangePop
+except ImportError:
+    range_push, range_pop = nvtx.range_push, nvtx.range_pop
+
+# Environment variables set in the profiled process by Nsight Systems and
+# other CUPTI / NVTX injection based tools. If none of them is set, nothing
+# records the NVTX markers and init() does not patch anything.
+PROFILER_ENV_VARS = ("NSYS_PROFILING_SESSION_ID", "NVTX_INJECTION64_PATH", "CUDA_INJECTION64_PATH")
+
+# The wrappers emit NVTX markers only while enabled (see enable / disable)
+enabled = True
+
+# The torch functions are monkey patched only once
+patched = False
+
+# Functions of torch and torch.Tensor that only return a view of a tensor or
+# its metadata. They do not launch GPU work, so their wrappers push a constant
+# marker without the call trace and the arguments (see add_metadata_wrapper).
+METADATA_OPS = frozenset(
+    [
+        'as_strided', 'chunk', 'diagonal', 'element_size', 'expand', 'expand_as', 'get_device', 'is_contiguous',
+        'is_pinned', 'is_same_size', 'is_set_to', 'is_shared', 'is_signed', 'movedim', 'narrow', 'ndimension',
+        'nelement', 'permute', 'select', 'split', 'squeeze', 'squeeze_', 'storage_offset', 'stride', 'swapaxes',
+        'swapdims', 't', 't_', 'transpose', 'transpose_', 'unbind', 'unfold', 'unsqueeze', 'unsqueeze_', 'view',
+        'view_as'
+    ]
+)
 
-
-
-def isfunc(mod, f):
-    assert hasattr(mod, f)
-    attr = getattr(mod, f)
-
-    # Ignore functions like _add
-    if (len(f) >= 2):
-        if f[0] == "_" and f[1] != "_":
-            return False
-
-    # Ignore functions from this list
-    ignore = [
+# Ignore functions from this list
+IGNORE_FUNCS = frozenset(
+    [
         '__all__', '__array__', '__array_priority__', '__array_wrap__', '__bool__', '__builtins__', '__cached__',
         '__class__', '__deepcopy__', '__delattr__', '__delitem__', '__dict__', '__dir__', '__doc__', '__file__',
         '__format__', '__getattribute__', '__getitem__', '__hash__', '__index__', '__init__', '__init_subclass__',
@@ -62,53 +91,161 @@ def isfunc(mod, f):
         '__path__', '__reduce__', '__reduce_ex__', '__repr__', '__reversed__', '__setattr__', '__setitem__',
         '__setstate__', '__sizeof__', '__spec__', '__str__', '__subclasshook__', '__version__', '__weakref__'
     ]
+)
 
-    # Add functions to this list if they cause recursion
-    ignore += ['size', 'tolist', 'dim', 'is_storage', 'item', 'data_ptr']
+# Add functions to this list if they cause recursion
+IGNORE_FUNCS |= frozenset(['size', 'tolist', 'dim', 'is_storage', 'item', 'data_ptr'])
 
-    # Add functions to this list if they are called often, are generally extremely
-    # short, and don't lead GPU usage
-    #
-    ignore += [
+# Add functions to this list if Python or PyTorch call them behind the scenes.
+# Wrapping a classmethod (__torch_function__) also binds it to the base class.
+IGNORE_FUNCS |= frozenset(['__getattr__', '__getstate__', '__torch_dispatch__', '__torch_function__'])
+
+# Add functions to this list if they are called often, are generally extremely
+# short, and don't lead GPU usage
+#
+IGNORE_FUNCS |= frozenset(
+    [
         'autocast_decrement_nesting', 'autocast_increment_nesting', 'contiguous', 'detach', 'empty', 'from_numpy',
         'has_torch_function', 'is_autocast_enabled', 'is_available', 'is_complex', 'is_floating_point',
         'is_grad_enabled', 'is_initialized', 'is_tensor', 'numel', 'requires_grad_', 'set_autocast_enabled', 'to',
         'type'
     ]
+)
+
+# Types of the attributes which are wrapped. This is what inspect's
+# ismethod, isfunction, ismethoddescriptor and isbuiltin accept for the
+# attributes of torch (including functools.lru_cache wrapped functions),
+# without probing every attribute for dunder methods.
+FUNC_TYPES = (
+    types.FunctionType, types.MethodType, types.BuiltinFunctionType, types.MethodDescriptorType,
+    types.WrapperDescriptorType, types.MethodWrapperType, types.ClassMethodDescriptorType,
+    type(functools.lru_cache()(lambda: None))
+)
 
-    if f in ignore:
+
+def isfunc(mod, f):
+    # Ignore functions like _add
+    if (len(f) >= 2):
+        if f[0] == "_" and f[1] != "_":
+            return False
+
+    if f in IGNORE_FUNCS:
         return False
-    return ins.ismethod(attr) or ins.isfunction(attr) or ins.ismethoddescriptor(attr) or ins.isbuiltin(attr)
 
+    attr = getattr(mod, f, None)
+    if attr is None:
+        return False
+
+    if not isinstance(attr, FUNC_TYPES):
+        return False
+
+    # Do not wrap a wrapper again
+    return not getattr(attr, "__pyprof_wrapped__", False)
+
+
+DEFAULT_TRACE_DEPTH = 16
 
-# Returns a dict string with a tracemarker and function stack in it
+
+def traceDepth():
+    """
+    Returns the number of frames set by PYPROF_TRACE_DEPTH, a positive integer.
+    An invalid value is ignored with a warning.
+    """
+    value = os.environ.get("PYPROF_TRACE_DEPTH")
+    if value is None:
+        return DEFAULT_TRACE_DEPTH
+    try:
+        depth = int(value)
+    except ValueError:
+        depth = 0
+    if depth <= 0:
+        warnings.warn(
+            "PYPROF_TRACE_DEPTH must be a positive integer, got {!r}. Using {}.".format(value, DEFAULT_TRACE_DEPTH)
+        )
+        return DEFAULT_TRACE_DEPTH
+    return depth
+
+
+# Number of (not blocked) frames kept in the call trace of a marker
+TRACE_DEPTH = traceDepth()
+
+# File name -> whether its frames are removed from the call trace
+traceBlockedFiles = {}
+
+
+def fast_stack(depth=None):
+    """
+    Returns the call stack of the caller of the wrapper as a list of
+    "file_name:line_number", outermost frame first. Frames of the
+    TRACE_BLOCKED files are skipped and at most depth (TRACE_DEPTH)
+    of the innermost frames are kept. This is a cheaper replacement for
+    traceback.extract_stack(), it does not create FrameSummary objects
+    or read the source lines from disk.
+    """
+    if depth is None:
+        depth = TRACE_DEPTH
+    blocked = traceBlockedFiles
+    # The wrapper may be called from C without a Python caller (a thread
+    # started with _thread, a hook), sys._getframe(2) would raise then
+    f = sys._getframe(1).f_back
+    stack = []
+    while (f is not None) and (len(stack) < depth):
+        fn = f.f_code.co_filename
+        b = blocked.get(fn)
+        if b is None:
+            b = blocked[fn] = traceBlocked.search(fn) is not None
+        if not b:
+            stack.append(f"{fn}:{f.f_lineno}")
+        f = f.f_back
+    stack.reverse()
+    return stack
+
+
+# Returns a JSON string with a tracemarker and function stack in it
 #
 def traceMarker(stack):
-    d = {}
-    cadena = []
-    for i in range(len(stack) - 1):
-        fi = stack[i]
-        t = f"{fi.filename}:{fi.lineno}"
-        cadena.append(t)
-    d['traceMarker'] = cadena
-    return str(d)
+    return json.dumps({'traceMarker': stack})
+
+
+# Module instance -> {wrapped class name: extra_repr() marker}
+reprMarkerCache = weakref.WeakKeyDictionary()
 
 
 def modMarker(mod, fn_name, args):
     """
 	Returns the stringified extra_repr() of a module.
+	It is computed on the first call and cached for the module instance,
+	changes of the module attributes after that are not reflected.
 	"""
     assert (len(args) > 0)
-    d = {}
-    d['mod'] = mod.__name__
-    d['strRepr'] = args[0].extra_repr()
-    return str(d)
+    obj = args[0]
+    try:
+        cache = reprMarkerCache.get(obj)
+        if cache is None:
+            cache = reprMarkerCache[obj] = {}
+    except TypeError:
+        # The instance is not hashable or does not support weak references
+        cache = {}
+
+    # A module instance is called through the forward of its class
+    # and of its base classes, the marker has the name of the wrapped class.
+    m = cache.get(mod.__name__)
+    if m is None:
+        d = {}
+        d['mod'] = mod.__name__
+        d['strRepr'] = obj.extra_repr()
+        m = cache[mod.__name__] = str(d)
+    return m
 
 
 def add_wrapper(mod, fn_name):
     # Get a pointer to the original function
     func = getattr(mod, fn_name)
 
+    # Do not wrap a wrapper again
+    if getattr(func, "__pyprof_wrapped__", None):
+        return
+
     # Check if the mod has a string representation
     # and is not a Script or Traced module (used by JIT)
     # yapf: disable
@@ -116,23 +253,34 @@ def add_wrapper(mod, fn_name):
                                         ) and (type(mod) is not torch.jit.TopLevelTracedModule)
 
     # yapf: enable
+    # The module and op names are fixed for this wrapper
+    prefix = sys.intern(argPrefix(mod, fn_name))
+
+    # The wrapper looks these up on every call, closure variables are
+    # faster to read than module globals
+    push, pop, join = range_push, range_pop, "\n".join
+    getStack, getArgMarker, getTraceMarker = fast_stack, argMarker, traceMarker
+
     # print(f'wrap {mod.__name__}:{fn_name}')
+    @functools.wraps(func)
     def wrapper_func(*args, **kwargs):
 
-        # Extract the stacktrace
-        stack = traceback.extract_stack()
+        if not enabled:
+            return func(*args, **kwargs)
 
-        # Push trace marker
-        nvtx.range_push(traceMarker(stack))
+        # Extract the stacktrace
+        stack = getStack()
 
-        # Push module marker
-        if s:
-            m = modMarker(mod, fn_name, args)
-            nvtx.range_push(m)
+        # Module marker
+        m = modMarker(mod, fn_name, args) if s else ""
 
-        # Create and push argument marker
-        cadena = argMarker(mod, fn_name, args, kwargs)
-        nvtx.range_push(cadena)
+        # Push a single marker made of the argument marker, the module
+        # marker and the trace marker, separated by newlines.
+        # The module and trace markers never hold a newline (their strings are
+        # escaped), the argument marker can: a list starting with a scalar is
+        # formatted with %r, including the tensors in it. Parsers split from the right.
+        cadena = getArgMarker(mod, fn_name, args, kwargs, prefix)
+        push(join((cadena, m, getTraceMarker(stack))))
 
         # # Create and push layer marker
         # info = 'layer:' +  mod.__name__ + ',' + fn_name
@@ -144,122 +292,178 @@ def add_wrapper(mod, fn_name):
         # # pop layer marker
         # nvtx.range_pop()
 
-        # Pop argumet marker
-        nvtx.range_pop()
+        # Pop the marker
+        pop()
+
+        return result
+
+    wrapper_func.__pyprof_wrapped__ = (mod.__name__, fn_name)
+    setattr(mod, fn_name, wrapper_func)
+
 
-        # Pop module marker
-        if s:
-            nvtx.range_pop()
+def add_metadata_wrapper(mod, fn_name):
+    """
+    Wrap a function that does not launch GPU work (see METADATA_OPS).
+    The pushed marker only has the module and op names, it is built
+    (and interned) once.
+    """
+    func = getattr(mod, fn_name)
 
-        # Pop trace marker
-        nvtx.range_pop()
+    # Do not wrap a wrapper again
+    if getattr(func, "__pyprof_wrapped__", None):
+        return
+
+    marker = sys.intern("\n".join((argPrefix(mod, fn_name) + "]}", "", traceMarker([]))))
+    push, pop = range_push, range_pop
+
+    @functools.wraps(func)
+    def wrapper_func(*args, **kwargs):
+
+        if not enabled:
+            return func(*args, **kwargs)
+
+        push(marker)
+        result = func(*args, **kwargs)
+        pop()
 
         return result
 
+    wrapper_func.__pyprof_wrapped__ = (mod.__name__, fn_name)
     setattr(mod, fn_name, wrapper_func)
 
 
-def argMarker(mod, op, args, kwargs):
-    # For this function args is a tuple and kwargs is a dict
+def argPrefix(mod, op):
+    """
+    Returns the leading part of the argument marker of mod.op
+    It does not depend on the arguments and can be computed once per wrapper.
+    """
+    return "{'mod': %r, 'op': %r, 'args': [" % (mod.__name__, op)
+
+
+# torch.dtype -> the dtype fragment of a tensor marker, e.g. "'float32'"
+DTYPE_REPRS = {}
+
+
+def argTensor(arg, name, frags):
+    if arg.dim() == 0:
+        argScalar(arg.item(), name, frags)
+    else:
+        dtype = DTYPE_REPRS.get(arg.dtype)
+        if dtype is None:
+            dtype = DTYPE_REPRS[arg.dtype] = repr(str(arg.dtype).split(".")[-1])
+        frags.append("{'name': %r, 'type': 'tensor', 'shape': %r, 'dtype': %s}" % (name, tuple(arg.size()), dtype))
 
-    def tensor(arg, name=""):
-        a = {}
-        a['name'] = name
-        a['type'] = "tensor"
-        a['shape'] = tuple(arg.size())
-        a['dtype'] = str(arg.dtype).split(".")[-1]
-        cadena['args'].append(a)
-
-    def ndarray(arg, name=""):
-        a = {}
-        a['name'] = name
-        a['type'] = "ndarray"
-        a['shape'] = arg.shape
-        a['dtype'] = str(arg.dtype).split(".")[-1]
-        cadena['args'].append(a)
-
-    def seq(arg, name=""):
-        assert issequence(arg)
-        a = {}
-        a['name'] = name
+
+def argNdarray(arg, name, frags):
+    frags.append(
+        "{'name': %r, 'type': 'ndarray', 'shape': %r, 'dtype': %r}" % (name, arg.shape, str(arg.dtype).split(".")[-1])
+    )
+
+
+def argScalar(arg, name, frags):
+    # handle the case when the argument is +/- inf or nan
+    if (type(arg) is float) and not math.isfinite(arg):
+        value = "nan" if math.isnan(arg) else ("inf" if arg > 0 else "-inf")
+    else:
+        value = arg
+    frags.append("{'name': %r, 'type': %r, 'value': %r}" % (name, type(arg).__name__, value))
+
+
+def argSequence(arg, name, frags):
+    if (len(arg) == 0) or (type(arg[0]) in SCALAR_TYPES):  # An empty sequence or a sequence of scalars
         if isinstance(arg, list):
-            a['type'] = "list"
-            a['value'] = arg
+            frags.append("{'name': %r, 'type': 'list', 'value': %r}" % (name, arg))
         else:
-            a['type'] = "tuple"
             # The arg could be torch.Size, which is a subclass of tuple
             # Therefore, explicitly convert to tuple
-            a['value'] = tuple(arg)
-
-        cadena['args'].append(a)
-
-    def scalar(arg, name=""):
-        a = {}
-        a['name'] = name
-        a['type'] = type(arg).__name__
-        # handle the case when the argument is +/- inf or nan
-        if arg == float('inf'):
-            a['value'] = "inf"
-        elif arg == float('-inf'):
-            a['value'] = "-inf"
-        elif isinstance(arg, float) and math.isnan(arg):
-            a['value'] = "nan"
-        else:
-            a['value'] = arg
-        cadena['args'].append(a)
-
-    def isscalar(arg):
-        return (type(arg) is int) or (type(arg) is float) or (type(arg) is bool) or (arg is None) or (type(arg) is str)
-
-    def issequence(arg):
-        return isinstance(arg, list) or isinstance(arg, tuple)
-
-    def foo(args, name):
-        # args should be an iterable sequence e.g. list or tuple
-        for arg in args:
-            if isinstance(arg, torch.Tensor):
-                if arg.dim() == 0:
-                    scalar(arg.item(), name)
-                else:
-                    tensor(arg, name)
-            elif isinstance(arg, numpy.ndarray):
-                ndarray(arg, name)
-            elif (isscalar(arg)):
-                scalar(arg, name)
-            elif issequence(arg):
-                if (len(arg) == 0) or isscalar(arg[0]):  # An empty sequence or a sequence of scalars
-                    seq(arg, name)
-                else:  # A sequence of tensors or numpy arrays
-                    foo(arg, name)
-            '''
-			else:
-				print("The following arg is none of Tensor, numpy array, scalar but a %s" % (str(type(arg))))
-				print("Mod: %s" % str(mod.__name__))
-				print("Op: %s" % str(op))
-				print(dir(arg))
-			'''
-
-    cadena = {}
-    cadena['mod'] = mod.__name__
-    cadena['op'] = op
-    cadena['args'] = []
-
-    foo(args, "")
+            frags.append("{'name': %r, 'type': 'tuple', 'value': %r}" % (name, tuple(arg)))
+    else:  # A sequence of tensors or numpy arrays
+        argList(arg, name, frags)
+
+
+def argIgnore(arg, name, frags):
+    # The arg is none of Tensor, numpy array, scalar or sequence
+    pass
+
+
+SCALAR_TYPES = frozenset([int, float, bool, str, type(None)])
+
+# Argument type -> function appending its marker fragment.
+# Other types are resolved with isinstance() once and added by argHandler.
+ARG_HANDLERS = {
+    int: argScalar,
+    float: argScalar,
+    bool: argScalar,
+    str: argScalar,
+    type(None): argScalar,
+    list: argSequence,
+    tuple: argSequence,
+    torch.Tensor: argTensor,
+    numpy.ndarray: argNdarray,
+}
+
+
+def argHandler(arg):
+    """
+    Returns the handler of an argument whose type is not in ARG_HANDLERS
+    (e.g. a subclass of torch.Tensor or tuple) and caches it.
+    """
+    if isinstance(arg, torch.Tensor):
+        h = argTensor
+    elif isinstance(arg, numpy.ndarray):
+        h = argNdarray
+    elif isinstance(arg, (list, tuple)):
+        h = argSequence
+    else:
+        h = argIgnore
+    ARG_HANDLERS[type(arg)] = h
+    return h
+
+
+def argList(args, name, frags):
+    # args should be an iterable sequence e.g. list or tuple
+    for arg in args:
+        h = ARG_HANDLERS.get(type(arg))
+        if h is None:
+            h = argHandler(arg)
+        h(arg, name, frags)
+
+
+def argMarker(mod, op, args, kwargs, prefix=None):
+    # For this function args is a tuple and kwargs is a dict
+    # The marker is assembled from preformatted fragments and is identical
+    # to str() of the dict {'mod': ..., 'op': ..., 'args': [...]}
+    if prefix is None:
+        prefix = argPrefix(mod, op)
+    frags = []
+
+    argList(args, "", frags)
     for k, v in kwargs.items():
-        foo((v,), k)
+        argList((v, ), k, frags)
 
-    return str(cadena)
+    return prefix + ", ".join(frags) + "]}"
 
 
-def patchClass(cls):
+def patchClass(cls, metadataOps=frozenset()):
+    """
+    Wrap the functions of cls. The functions named in metadataOps
+    get the constant marker of add_metadata_wrapper.
+    """
     for f in dir(cls):
         if isfunc(cls, f):
-            add_wrapper(cls, f)
+            if f in metadataOps:
+                add_metadata_wrapper(cls, f)
+            else:
+                add_wrapper(cls, f)
 
 
 def patch_torch_classes():
     """Monkey-patch all classes in torch"""
-    for cls in [torch, torch.Tensor, torch.nn.functional, torch.distributed]:
+    # METADATA_OPS are views in torch and torch.Tensor only,
+    # e.g. torch.nn.functional.unfold is im2col and launches a kernel
+    for cls in [torch, torch.Tensor]:
+        patchClass(cls, METADATA_OPS)
+    for cls in [torch.nn.functional, torch.distributed]:
         patchClass(cls)
 
 
@@ -276,32 +480,22 @@ def patch_dataloader():
     old_iter = mod.DataLoader.__iter__
 
     def new_iter(self, *args, **kwargs):
-        # Push trace marker
-        nvtx.range_push(traceMarker("Dataloader"))
-
         # First pass is for creating the dataloader + returning the first data
         cadena = argMarker(mod, "DataLoader", args, kwargs)
-        nvtx.range_push(cadena)
+        range_push("\n".join((cadena, "", traceMarker([]))))
 
         for x in old_iter(self, *args, **kwargs):
-            # Pop tracemarker
-            nvtx.range_pop()
-
             # Dataloader stop, Model start
-            nvtx.range_pop()
+            range_pop()
 
             yield x
 
-            # Push trace marker
-            nvtx.range_push(traceMarker("DataLoader"))
-
             # Model stop, dataloader start
             cadena = argMarker(mod, "DataLoader", args, kwargs)
-            nvtx.range_push(cadena)
+            range_push("\n".join((cadena, "", traceMarker([]))))
 
         # Pop the last iteration before returning
-        nvtx.range_pop()
-        nvtx.range_pop()
+        range_pop()
 
     mod.DataLoader.__iter__ = new_iter
 
@@ -399,10 +593,24 @@ def patch_apex_class(cls):
                 add_wrapper(cls, f)
 
 
-def init(*args, **kwargs):
+def profilerAttached():
     """
-    Initialize pyprof and monkey-patch Torch functions
+    Returns true if the process seems to be running under a profiler
     """
+    return any(os.environ.get(v) for v in PROFILER_ENV_VARS)
+
+
+def enable():
+    """
+    Emit NVTX markers from the wrapped functions.
+    The torch functions are monkey patched the first time this is called.
+    Patching is one shot, it is never undone.
+    """
+    global enabled, patched
+    enabled = True
+    if patched:
+        return
+    patched = True
 
     print("Initializing NVTX monkey patches")
 
@@ -412,3 +620,29 @@ def init(*args, **kwargs):
     # 找到所有的module,修改其中的forward函数，即对forward进行封装，在其前后设置nvmarker，用于监测
     patch_torch_nn_forward_functions()
     print("Done with NVTX monkey patching")
+
+
+def disable():
+    """
+    Stop emitting NVTX markers. The wrapped functions call the
+    original functions directly until enable() is called again.
+    """
+    global enabled
+    enabled = False
+
+
+def init(*args, force=False, **kwargs):
+    """
+    Initialize pyprof and monkey-patch Torch functions.
+    If no profiler is attached to the process, the patching is skipped
+    so that the functions run without any overhead. Use force=True or
+    call enable() later to patch anyway.
+    """
+    global enabled
+
+    if not (force or profilerAttached()):
+        enabled = False
+        print("No profiler detected, skipping NVTX monkey patches")
+        return
+
+    enable()
@@ -36,11 +36,17 @@ class DB(object):
         self.conn = conn
         self.c = c
 
-    def select(self, cmd):
+    def select(self, cmd, rows=False):
+        """
+		Return the result of a query as a list of dicts, or of sqlite3.Row
+		objects if rows is True. The rows are indexed by column name like
+		a dict, and are much smaller than a dict per row.
+		"""
         try:
             self.c.execute(cmd)
-            #rows = self.c.fetchall()
-            rows = [dict(row) for row in self.c.fetchall()]
+            result = self.c.fetchall()
+            if not rows:
+                result = [dict(row) for row in result]
         except sqlite3.Error as e:
             print(e)
             sys.exit(1)
@@ -48,8 +54,7 @@ class DB(object):
             print("Uncaught error in SQLite access while executing {}".format(cmd))
             sys.exit(1)
 
-        #print(rows)
-        return rows
+        return result
 
     def insert(self, cmd, data):
         try:
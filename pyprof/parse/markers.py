@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2021, NVIDIA CORPORATION. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import re
+import bisect
+from collections import namedtuple
+
+Marker = namedtuple('Marker', ['startTime', 'endTime', 'id', 'name', 'category', 'bprop'])
+
+# Categories of the NVTX markers. The category of a marker is found once,
+# when it is read from the database, see markerCategory.
+CAT_OTHER, CAT_PYPROF, CAT_ARGS, CAT_LAYER, CAT_TRACE, CAT_REPR, CAT_SEQ, CAT_CHECKPOINT = range(8)
+
+# Frames from these files are removed from the call trace of a kernel
+TRACE_BLOCKED = (
+    "/torch/nn/modules/", "/torch/nn/functional.py", "/torch/tensor.py", "/torch/autograd/__init__.py",
+    "/torch/_jit_internal.py", "/pyprof/nvtx/nvmarker.py", "/apex/optimizers/", "/torch/_utils.py", "/torch/optim/"
+)
+traceBlocked = re.compile("|".join(map(re.escape, TRACE_BLOCKED)))
+
+
+def filterFrames(mlist):
+    """
+	Remove the frames of TRACE_BLOCKED files from a call trace.
+	"""
+    search = traceBlocked.search
+    return [x for x in mlist if not search(x)]
+
+
+def markerCategory(m):
+    """
+	Return the category of a marker and whether it is a backward pass marker.
+	"""
+    #Hack: If its a known gradient checkpointing marker, ignore it.
+    if m.find("CheckpointFunctionBackward") >= 0:
+        return CAT_CHECKPOINT, False
+
+    bprop = ("_backward, seq =" in m) or ("Backward, seq =" in m) or ("Backward0, seq =" in m)
+
+    if m.startswith("{'mod': ") and ("\n" in m):
+        #Marker pushed by pyprof: argument, extra_repr() and trace markers
+        c = CAT_PYPROF
+    elif ("mod" in m) and ("op" in m) and ("args" in m) and ("type" in m):
+        c = CAT_ARGS
+    elif ("layer:" in m):
+        c = CAT_LAYER
+    elif ("traceMarker" in m):
+        c = CAT_TRACE
+    elif ("strRepr" in m):
+        c = CAT_REPR
+    elif (", seq = " in m):
+        c = CAT_SEQ
+    else:
+        c = CAT_OTHER
+    return c, bprop
+
+
+def newMarker(startTime, endTime, id_, name):
+    """
+	Create a Marker, with the category of its name.
+	"""
+    return Marker(startTime, endTime, id_, name, *markerCategory(name))
+
+
+class ThreadMarkers(object):
+    """
+	NVTX markers (ranges) of one thread, read once from the database.
+	Kernels are looked up in the order of their launch time, and the
+	markers are swept in the order of their start time. Markers which
+	ended before the launch of a previous kernel are dropped.
+	"""
+
+    def __init__(self, markers):
+        self.markers = markers  # sorted by start time
+        self.next = 0  # markers[:next] have been opened
+        self.open = []  # opened markers which have not been dropped
+        self.dropTime = 0  # markers ending before this time are dropped
+        self.byId = None
+        self.ids = None
+
+    def encapsulating(self, startTime, endTime):
+        """
+		Return the markers which begin before startTime and end after endTime,
+		sorted by start time.
+		"""
+        markers = self.markers
+        i = self.next
+        while (i < len(markers)) and (markers[i].startTime < startTime):
+            if markers[i].endTime >= self.dropTime:
+                self.open.append(markers[i])
+            i += 1
+        self.next = i
+
+        return [m for m in self.open if (m.startTime < startTime) and (m.endTime > endTime)]
+
+    def between(self, loId, hiId):
+        """
+		Return the markers with loId < id < hiId, sorted by start time.
+		"""
+        if self.byId is None:
+            self.byId = sorted(self.markers, key=lambda m: m.id)
+            self.ids = [m.id for m in self.byId]
+
+        lo = bisect.bisect_right(self.ids, loId)
+        hi = bisect.bisect_left(self.ids, hiId)
+        result = [m for m in self.byId[lo:hi] if m.endTime >= self.dropTime]
+        result.sort()
+        return result
+
+    def drop(self, sTime):
+        """
+		Drop the markers which ended before sTime. They can not
+		encapsulate kernels launched later on.
+		"""
+        if sTime > self.dropTime:
+            self.dropTime = sTime
+            self.open = [m for m in self.open if m.endTime >= sTime]
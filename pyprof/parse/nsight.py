@@ -16,6 +16,11 @@
 # limitations under the License.
 
 import sys
+import json, ast
+from itertools import groupby
+
+from .markers import newMarker, ThreadMarkers, filterFrames
+from .markers import CAT_PYPROF, CAT_ARGS, CAT_LAYER, CAT_TRACE, CAT_REPR, CAT_SEQ, CAT_OTHER, CAT_CHECKPOINT
 
 
 class Nsight(object):
@@ -55,14 +60,18 @@ class Nsight(object):
 
     def createMarkerTable(self):
         """
-		Create a temporary table and index it to speed up repeated SQL quesries.
+		Read all the NVTX ranges with a single query, sorted by thread and start time.
+		The markers of every thread are then swept once by getMarkerInfo.
 		"""
-        cmd = 'CREATE TEMPORARY TABLE marker AS SELECT * FROM {}'.format(self.markerT)
-        self.db.execute(cmd)
+        cmd = 'SELECT rowid AS id, start, end, globalTid, text FROM {} \
+				WHERE end IS NOT NULL AND text IS NOT NULL \
+				ORDER BY globalTid, start, id'.format(self.markerT)
+        result = self.db.select(cmd, rows=True)
 
-        self.db.execute('CREATE INDEX start_index ON marker (start)')
-        self.db.execute('CREATE INDEX end_index ON marker (end)')
-        # self.db.execute('CREATE INDEX id_index ON marker (id)')
+        self.markers = {}
+        for objId, rows in groupby(result, key=lambda r: r['globalTid']):
+            markers = [newMarker(r['start'], r['end'], r['id'], r['text']) for r in rows]
+            self.markers[objId] = ThreadMarkers(markers)
 
     def encode_object_id(self, info):
         # Nothing to do for nsight. objId comes out of database
@@ -108,7 +117,7 @@ class Nsight(object):
                 "JOIN {} AS strings ON (kNameId = strings.Id) "
                 "JOIN {} AS runtime ON (kernels.correlationId = runtime.correlationId AND kpid = pid) "
             ).format(self.kernelT, self.stringT, self.runtimeT)
-        result = self.db.select(cmd)
+        result = self.db.select(cmd, rows=True)
         return result
 
     def getMarkerInfo(self, objId, startTime, endTime):
@@ -139,16 +148,6 @@ class Nsight(object):
 
         # Helper functions
 
-        def delete(objId, sTime):
-            """
-			Delete rows from the temporary SQL table which are no longer required.
-			This speeds up future queries.
-			"""
-            margin = 0
-            cmd = 'DELETE FROM marker WHERE globalTid = {} AND end < {}'.format(objId, sTime - margin)
-            # cmd = 'DELETE FROM marker WHERE end < {}'.format(sTime - margin)
-            self.db.execute(cmd)
-
         def getLayerName(mlist):
             """
 			Get layer names from layer marker list.
@@ -217,52 +216,48 @@ class Nsight(object):
             if len(mlist) == 0:
                 return mlist
             mlist = mlist[-1]  # The last stack trace will be a super set.
-            mlist = eval(mlist)
+            try:
+                mlist = json.loads(mlist)
+            except ValueError:
+                # Profiles from older versions of pyprof use python literals
+                mlist = ast.literal_eval(mlist)
             mlist = mlist['traceMarker']
             assert (type(mlist) == list)
-            mlist = list(filter(lambda x: "/torch/nn/modules/" not in x, mlist))
-            mlist = list(filter(lambda x: "/torch/nn/functional.py" not in x, mlist))
-            mlist = list(filter(lambda x: "/torch/tensor.py" not in x, mlist))
-            mlist = list(filter(lambda x: "/torch/autograd/__init__.py" not in x, mlist))
-            mlist = list(filter(lambda x: "/torch/_jit_internal.py" not in x, mlist))
-            mlist = list(filter(lambda x: "/pyprof/nvtx/nvmarker.py" not in x, mlist))
-            mlist = list(filter(lambda x: "/apex/optimizers/" not in x, mlist))
-            mlist = list(filter(lambda x: "/torch/_utils.py" not in x, mlist))
-            mlist = list(filter(lambda x: "/torch/optim/" not in x, mlist))
+            # pyprof filters the frames when it records the trace,
+            # profiles from older versions have the full call stack
+            mlist = filterFrames(mlist)
             return mlist
 
         # Find all encapsulating markers
-        cmd = 'SELECT text from marker where \
-				globalTid = {} and \
-				start < {} and \
-				end > {} \
-				ORDER BY start ASC'.format(objId, startTime, endTime)
-        result = self.db.select(cmd)
+        markers = self.markers.get(objId)
+        result = markers.encapsulating(startTime, endTime) if markers else []
 
         # Bin markers into different lists
+        bins = {
+            CAT_ARGS: pyprofMarkers,
+            CAT_LAYER: layerMarkers,
+            CAT_TRACE: traceMarkers,
+            CAT_REPR: reprMarkers,
+            CAT_SEQ: seqMarkers,
+            CAT_OTHER: otherMarkers
+        }
         for r in result:
-            # m = self.getString(r['name'])
-            m = r['text']
-
-            # Hack: If its a known gradient checkpointing marker, ignore it.
-            if m.find("CheckpointFunctionBackward") >= 0:
+            c = r.category
+            if c == CAT_CHECKPOINT:
                 continue
 
-            if ("_backward, seq =" in m) or ("Backward, seq =" in m) or ("Backward0, seq =" in m):
+            if r.bprop:
                 bprop = True
 
-            if ("mod" in m) and ("op" in m) and ("args" in m) and ("type" in m):
-                pyprofMarkers.append(m)
-            elif ("layer:" in m):
-                layerMarkers.append(m)
-            elif ("traceMarker" in m):
-                traceMarkers.append(m)
-            elif ("strRepr" in m):
-                reprMarkers.append(m)
-            elif (", seq = " in m):
-                seqMarkers.append(m)
+            if c == CAT_PYPROF:
+                # The argument marker can hold newlines (the repr() of a tensor inside a list)
+                argM, reprM, traceM = r.name.rsplit("\n", 2)
+                pyprofMarkers.append(argM)
+                if reprM:
+                    reprMarkers.append(reprM)
+                traceMarkers.append(traceM)
             else:
-                otherMarkers.append(m)
+                bins[c].append(r.name)
 
         # Remove duplicates, sort and prune seqMarkers
         if (len(seqMarkers)):
@@ -299,8 +294,9 @@ class Nsight(object):
 			'''
             pass
 
-        delete(objId, startTime)
-        # delete("", startTime)
+        # Markers which ended before this kernel are not needed anymore
+        if markers:
+            markers.drop(startTime)
 
         return layerMarkers, filterTrace(
             traceMarkers
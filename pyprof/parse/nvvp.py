@@ -16,7 +16,12 @@
 # limitations under the License.
 
 import sys
+import json, ast
 import struct, binascii
+from itertools import groupby
+
+from .markers import newMarker, ThreadMarkers, filterFrames
+from .markers import CAT_PYPROF, CAT_ARGS, CAT_LAYER, CAT_TRACE, CAT_REPR, CAT_SEQ, CAT_OTHER, CAT_CHECKPOINT
 
 
 class NVVP(object):
@@ -33,6 +38,7 @@ class NVVP(object):
     def __init__(self, db):
         self.db = db
         self.markerId = 0
+        self.strings = {}  # cache of getString
 
     def getProfileStart(self):
         """
@@ -52,53 +58,43 @@ class NVVP(object):
         assert (profStart < sys.maxsize)
         return profStart
 
-    def getKernelColumns(self):
-        cmd = (
-            "SELECT "
-            "name AS kNameId, "
-            "strings.value as name, "
-            "coalesce(runtime.start, driver.start) as rStart, "
-            "coalesce(runtime.end, driver.end) as rEnd, "
-            "coalesce(runtime.processId, driver.processId) as pid, "
-            "coalesce(runtime.threadId, driver.threadId) & 0xFFFFFFFF as tid, "
-            "kernels.correlationId,kernels.start,kernels.end,deviceId,streamId,"
-            # "kernels.staticSharedMemory,kernels.dynamicSharedMemory,kernels.localMemoryPerThread,kernels.LocalMemoryTotal,kernels.sharedMemoryExecuted,"
-            "gridX,gridY,gridZ,blockX,blockY,blockZ "
-            "FROM {} AS kernels "
-            "JOIN {} AS strings ON (KNameId = strings._id_) "
-            "LEFT JOIN {} AS runtime ON (kernels.correlationId = runtime.correlationId) "
-            "LEFT JOIN {} AS driver ON (kernels.correlationId = driver.correlationId) "
-        ).format(self.kernelT, self.stringT, self.runtimeT, self.driverT)
-        result = self.db.select(cmd)
-        return result
     def getString(self, id_):
         """
 		Get the string associated with an id.
+		The marker and kernel names are resolved by the queries, this is
+		only for the odd lookup, the strings are read and cached on demand.
 		"""
-        cmd = "select value from {} where _id_ = {}".format(self.stringT, id_)
-        result = self.db.select(cmd)
-        assert (len(result) == 1)
-        return result[0]['value']
+        value = self.strings.get(id_)
+        if value is None:
+            cmd = "select value from {} where _id_ = {}".format(self.stringT, id_)
+            result = self.db.select(cmd, rows=True)
+            assert (len(result) == 1)
+            value = self.strings[id_] = result[0]['value']
+        return value
 
     def createMarkerTable(self):
         """
-		Create a temporary table and index it to speed up repeated SQL quesries.
-		The table is an INNER JOIN of CUPTI_ACTIVITY_KIND_MARKER with itself.
+		Read all the markers with a single query, sorted by thread and start time.
+		The query is an INNER JOIN of CUPTI_ACTIVITY_KIND_MARKER with itself.
+		The markers of every thread are then swept once by getMarkerInfo.
 		"""
-        cmd = 'CREATE TEMPORARY TABLE marker AS SELECT \
+        cmd = 'SELECT \
 					a._id_ as id, \
 					a.timestamp AS startTime, \
 					b.timestamp AS endTime, \
 					HEX(a.objectId) AS objectId, \
-					a.name AS name \
+					strings.value AS name \
 					FROM {} AS a INNER JOIN {} AS b ON \
 					a.id = b.id and \
-					a.flags = 2 and b.flags = 4'.format(self.markerT, self.markerT)
-        self.db.execute(cmd)
+					a.flags = 2 and b.flags = 4 \
+					JOIN {} AS strings ON (a.name = strings._id_) \
+					ORDER BY objectId, startTime, id'.format(self.markerT, self.markerT, self.stringT)
+        result = self.db.select(cmd, rows=True)
 
-        self.db.execute('CREATE INDEX start_index ON marker (startTime)')
-        self.db.execute('CREATE INDEX end_index ON marker (endTime)')
-        self.db.execute('CREATE INDEX id_index ON marker (id)')
+        self.markers = {}
+        for objId, rows in groupby(result, key=lambda r: r['objectId']):
+            markers = [newMarker(r['startTime'], r['endTime'], r['id'], r['name']) for r in rows]
+            self.markers[objId] = ThreadMarkers(markers)
 
     def encode_object_id(self, info):
         """
@@ -128,7 +124,7 @@ class NVVP(object):
             "LEFT JOIN {} AS runtime ON (kernels.correlationId = runtime.correlationId) "
             "LEFT JOIN {} AS driver ON (kernels.correlationId = driver.correlationId) "
         ).format(self.kernelT, self.stringT, self.runtimeT, self.driverT)
-        result = self.db.select(cmd)
+        result = self.db.select(cmd, rows=True)
         return result
 
     def getMarkerInfo(self, objId, startTime, endTime):
@@ -159,16 +155,6 @@ class NVVP(object):
 
         #Helper functions
 
-        def delete(objId, sTime):
-            """
-			Delete rows from the temporary SQL table which are no longer required.
-			This speeds up future queries.
-			"""
-            margin = 0
-            cmd = 'DELETE FROM marker WHERE objectId = "{}" AND endTime < {}'.format(objId, sTime - margin)
-            #cmd = 'DELETE FROM marker WHERE endTime < {}'.format(sTime - margin)
-            self.db.execute(cmd)
-
         def getLayerName(mlist):
             """
 			Get layer names from layer marker list.
@@ -237,51 +223,48 @@ class NVVP(object):
             if len(mlist) == 0:
                 return mlist
             mlist = mlist[-1]  #The last stack trace will be a super set.
-            mlist = eval(mlist)
+            try:
+                mlist = json.loads(mlist)
+            except ValueError:
+                #Profiles from older versions of pyprof use python literals
+                mlist = ast.literal_eval(mlist)
             mlist = mlist['traceMarker']
             assert (type(mlist) == list)
-            mlist = list(filter(lambda x: "/torch/nn/modules/" not in x, mlist))
-            mlist = list(filter(lambda x: "/torch/nn/functional.py" not in x, mlist))
-            mlist = list(filter(lambda x: "/torch/tensor.py" not in x, mlist))
-            mlist = list(filter(lambda x: "/torch/autograd/__init__.py" not in x, mlist))
-            mlist = list(filter(lambda x: "/torch/_jit_internal.py" not in x, mlist))
-            mlist = list(filter(lambda x: "/pyprof/nvtx/nvmarker.py" not in x, mlist))
-            mlist = list(filter(lambda x: "/apex/optimizers/" not in x, mlist))
-            mlist = list(filter(lambda x: "/torch/_utils.py" not in x, mlist))
-            mlist = list(filter(lambda x: "/torch/optim/" not in x, mlist))
+            # pyprof filters the frames when it records the trace,
+            # profiles from older versions have the full call stack
+            mlist = filterFrames(mlist)
             return mlist
 
         #Find all encapsulating markers
-        cmd = 'SELECT id,name from marker where \
-				objectId = "{}" and \
-				startTime < {} and \
-				endTime > {} \
-				ORDER BY startTime ASC'.format(objId, startTime, endTime)
-        result = self.db.select(cmd)
+        markers = self.markers.get(objId)
+        result = markers.encapsulating(startTime, endTime) if markers else []
 
         #Bin markers into different lists
+        bins = {
+            CAT_ARGS: pyprofMarkers,
+            CAT_LAYER: layerMarkers,
+            CAT_TRACE: traceMarkers,
+            CAT_REPR: reprMarkers,
+            CAT_SEQ: seqMarkers,
+            CAT_OTHER: otherMarkers
+        }
         for r in result:
-            m = self.getString(r['name'])
-
-            #Hack: If its a known gradient checkpointing marker, ignore it.
-            if m.find("CheckpointFunctionBackward") >= 0:
+            c = r.category
+            if c == CAT_CHECKPOINT:
                 continue
 
-            if ("_backward, seq =" in m) or ("Backward, seq =" in m) or ("Backward0, seq =" in m):
+            if r.bprop:
                 bprop = True
 
-            if ("mod" in m) and ("op" in m) and ("args" in m) and ("type" in m):
-                pyprofMarkers.append(m)
-            elif ("layer:" in m):
-                layerMarkers.append(m)
-            elif ("traceMarker" in m):
-                traceMarkers.append(m)
-            elif ("strRepr" in m):
-                reprMarkers.append(m)
-            elif (", seq = " in m):
-                seqMarkers.append(m)
+            if c == CAT_PYPROF:
+                #The argument marker can hold newlines (the repr() of a tensor inside a list)
+                argM, reprM, traceM = r.name.rsplit("\n", 2)
+                pyprofMarkers.append(argM)
+                if reprM:
+                    reprMarkers.append(reprM)
+                traceMarkers.append(traceM)
             else:
-                otherMarkers.append(m)
+                bins[c].append(r.name)
 
         #Remove duplicates, sort and prune seqMarkers
         if (len(seqMarkers)):
@@ -296,17 +279,12 @@ class NVVP(object):
         #Only for fprop kernels
         if (len(result) and not bprop):
             loId = self.markerId
-            hiId = result[-1]['id']
+            hiId = result[-1].id
             self.markerId = hiId
 
             #Get markers between loId and hiId
-            cmd = 'SELECT id,name from marker where objectId = "{}" and id > {} and id < {} ORDER BY startTime ASC'.format(
-                objId, loId, hiId
-            )
-            result1 = self.db.select(cmd)
-
-            for r in result1:
-                m = self.getString(r['name'])
+            for r in markers.between(loId, hiId):
+                m = r.name
                 #Get only markers with seq id
                 if (", seq=" in m):
                     altSeqMarkers.append(m)
@@ -317,7 +295,9 @@ class NVVP(object):
                 altSeqMarkers.sort(key=seqcompare)
                 altSeqMarkers = prune(altSeqMarkers)
 
-        delete(objId, startTime)
+        #Markers which ended before this kernel are not needed anymore
+        if markers:
+            markers.drop(startTime)
 
         return layerMarkers, filterTrace(
             traceMarkers
@@ -75,7 +75,8 @@ def main():
     Kernel.profStart = nvvp.getProfileStart()
 
     for i in tqdm(range(len(kInfo)), ascii=True):
-        info = kInfo[i]
+        # The rows are read only, encode_object_id adds to the dict
+        info = dict(kInfo[i])
         k = Kernel()
 
         # Calculate/encode object ID
@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2021, NVIDIA CORPORATION. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+'''
+This test compares the marker sweep of pyprof.parse.markers with the
+per kernel SELECT / DELETE queries it replaces, and checks the marker categories.
+'''
+import inspect
+import random
+import sqlite3
+import unittest
+
+from pyprof.parse.db import DB
+from pyprof.parse.nsight import Nsight
+from pyprof.parse.nvvp import NVVP
+from pyprof.parse.markers import newMarker, ThreadMarkers
+from pyprof.parse.markers import markerCategory
+from pyprof.parse.markers import CAT_PYPROF, CAT_ARGS, CAT_LAYER, CAT_TRACE, CAT_REPR, CAT_SEQ, CAT_OTHER
+from pyprof.parse.markers import CAT_CHECKPOINT
+
+
+class SqlMarkers(object):
+    """
+    The markers of one thread in a SQL table, queried and deleted
+    per kernel like the parsers used to do.
+    """
+
+    def __init__(self, markers):
+        self.conn = sqlite3.connect(":memory:")
+        self.conn.execute("CREATE TABLE marker (id INT, startTime INT, endTime INT, name TEXT)")
+        rows = [(m.id, m.startTime, m.endTime, m.name) for m in markers]
+        self.conn.executemany("INSERT INTO marker VALUES (?,?,?,?)", rows)
+
+    def encapsulating(self, startTime, endTime):
+        cmd = "SELECT id FROM marker WHERE startTime < ? AND endTime > ? ORDER BY startTime ASC"
+        return [r[0] for r in self.conn.execute(cmd, (startTime, endTime))]
+
+    def between(self, loId, hiId):
+        cmd = "SELECT id FROM marker WHERE id > ? AND id < ? ORDER BY startTime ASC"
+        return [r[0] for r in self.conn.execute(cmd, (loId, hiId))]
+
+    def drop(self, sTime):
+        self.conn.execute("DELETE FROM marker WHERE endTime < ?", (sTime, ))
+
+
+def randomMarkers(rng, n):
+    """
+    Returns n markers with distinct start times, sorted by start time.
+    The ids are not in the order of the start times.
+    """
+    starts = sorted(rng.sample(range(10 * n), n))
+    ids = rng.sample(range(1, 10 * n), n)
+    return [newMarker(s, s + rng.randint(1, 5 * n), i, "m{}".format(i)) for s, i in zip(starts, ids)]
+
+
+class TestMarkers(unittest.TestCase):
+
+    def __init__(self, testName):
+        super().__init__(testName)
+
+    def setUp(self):
+        pass
+
+    def tearDown(self):
+        pass
+
+    def sweep(self, seed, shuffle):
+        rng = random.Random(seed)
+        markers = randomMarkers(rng, 40)
+        ref = SqlMarkers(markers)
+        tm = ThreadMarkers(markers)
+
+        # Kernels sorted by launch time, some of them swapped with the next one
+        kernels = sorted((s, s + rng.randint(1, 10)) for s in rng.sample(range(400), 30))
+        if shuffle:
+            for i in range(0, len(kernels) - 1, 3):
+                kernels[i], kernels[i + 1] = kernels[i + 1], kernels[i]
+
+        for startTime, endTime in kernels:
+            result = tm.encapsulating(startTime, endTime)
+            self.assertEqual([m.id for m in result], ref.encapsulating(startTime, endTime))
+            loId, hiId = sorted(rng.sample(range(400), 2))
+            self.assertEqual([m.id for m in tm.between(loId, hiId)], ref.between(loId, hiId))
+            tm.drop(startTime)
+            ref.drop(startTime)
+
+    def test_sweep(self):
+        for seed in range(20):
+            self.sweep(seed, False)
+
+    def test_sweep_out_of_order(self):
+        for seed in range(20):
+            self.sweep(seed, True)
+
+    def test_category(self):
+        cases = [
+            ("{'mod': 'torch', 'op': 'add', 'args': []}\n\n{\"traceMarker\": []}", CAT_PYPROF, False),
+            ("{'mod': 'torch', 'op': 'add', 'args': [{'name': '', 'type': 'int', 'value': 1}]}", CAT_ARGS, False),
+            ("layer:conv1", CAT_LAYER, False),
+            ("{'traceMarker': ['a.py:1']}", CAT_TRACE, False),
+            ("{'mod': 'Linear', 'strRepr': 'in_features=3'}", CAT_REPR, False),
+            ("add, seq = 3", CAT_SEQ, False),
+            ("AddBackward0, seq = 3", CAT_SEQ, True),
+            ("CheckpointFunctionBackward, seq = 3", CAT_CHECKPOINT, False),
+            ("step", CAT_OTHER, False),
+        ]
+        for m, category, bprop in cases:
+            self.assertEqual(markerCategory(m), (category, bprop), m)
+
+    def test_pyprof_marker(self):
+        argM = "{'mod': 'Linear', 'op': 'forward', 'args': " \
+               "[{'name': '', 'type': 'tensor', 'shape': (2, 3), 'dtype': 'float32'}]}"
+        reprM = "{'mod': 'Linear', 'strRepr': 'in_features=3, out_features=4, bias=True'}"
+        traceM = '{"traceMarker": ["train.py:10"]}'
+        # A list starting with a scalar is formatted with %r, tensors included
+        listM = "{'mod': 'torch', 'op': 'cat', 'args': " \
+                "[{'name': '', 'type': 'list', 'value': [1, tensor([[1., 1.],\n        [1., 1.]])]}]}"
+        for a in (argM, listM):
+            for r in (reprM, ""):
+                m = newMarker(1, 2, 3, "\n".join((a, r, traceM)))
+                self.assertEqual(m.category, CAT_PYPROF)
+                self.assertEqual(m.name.rsplit("\n", 2), [a, r, traceM])
+
+    def test_parse_newline(self):
+        argM = "{'mod': 'torch', 'op': 'cat', 'args': " \
+               "[{'name': '', 'type': 'list', 'value': [1, tensor([[1., 1.],\n        [1., 1.]])]}]}"
+        reprM = "{'mod': 'Linear', 'strRepr': 'in_features=3'}"
+        traceM = '{"traceMarker": ["train.py:10"]}'
+        name = "\n".join((argM, reprM, traceM))
+
+        db = DB(":memory:")
+        db.execute("CREATE TABLE NVTX_EVENTS (start INT, end INT, eventType INT, text TEXT, globalTid INT)")
+        db.insert("INSERT INTO NVTX_EVENTS VALUES (?,?,?,?,?)", (10, 50, 59, name, 7))
+        nsight = Nsight(db)
+        nsight.createMarkerTable()
+        nsightInfo = nsight.getMarkerInfo(7, 20, 30)
+
+        objId = b"\x01\x02"
+        db = DB(":memory:")
+        db.execute("CREATE TABLE StringTable (_id_ INTEGER PRIMARY KEY, value TEXT)")
+        db.execute(
+            "CREATE TABLE CUPTI_ACTIVITY_KIND_MARKER (_id_ INTEGER PRIMARY KEY, flags INT, timestamp INT, id INT, "
+            "objectId BLOB, name INT)"
+        )
+        db.insert("INSERT INTO StringTable VALUES (?,?)", (1, name))
+        db.insert("INSERT INTO CUPTI_ACTIVITY_KIND_MARKER VALUES (?,?,?,?,?,?)", (1, 2, 10, 1, objId, 1))
+        db.insert("INSERT INTO CUPTI_ACTIVITY_KIND_MARKER VALUES (?,?,?,?,?,?)", (2, 4, 50, 1, objId, 0))
+        nvvp = NVVP(db)
+        nvvp.createMarkerTable()
+        nvvpInfo = nvvp.getMarkerInfo(objId.hex().upper(), 20, 30)
+
+        for info in (nsightInfo, nvvpInfo):
+            layerMarkers, traceMarkers, reprMarkers, pyprofMarkers = info[:4]
+            self.assertEqual(pyprofMarkers, [argM])
+            self.assertEqual(reprMarkers, [reprM])
+            self.assertEqual(traceMarkers, ["train.py:10"])
+
+
+def run_tests():
+    dummy = TestMarkers('test_sweep')
+    test_cases = list(
+        filter(lambda x: 'test_' in x, map(lambda x: x[0], inspect.getmembers(dummy, predicate=inspect.ismethod)))
+    )
+    suite = unittest.TestSuite()
+    for test_case in test_cases:
+        suite.addTest(TestMarkers(test_case))
+    result = unittest.TextTestRunner(verbosity=2).run(suite)
+    if result.wasSuccessful():
+        exit(0)
+    else:
+        exit(1)
+
+
+if __name__ == '__main__':
+    run_tests()
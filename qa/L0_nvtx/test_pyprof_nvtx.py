@@ -26,7 +26,7 @@ import unittest
 
 #from apex import pyprof
 import pyprof
-pyprof.nvtx.init()
+pyprof.nvtx.init(force=True)
 
 # TODO: add tests for:
 # F.bilinear, F.l1_loss, F.multilabel_soft_margin_loss, F.multi_margin_loss
@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2021, NVIDIA CORPORATION. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+'''
+This test exercises init(), enable() and disable() on the CPU.
+The NVTX calls are replaced by functions recording the pushed markers.
+'''
+import _thread
+import ast
+import copy
+import inspect
+import os
+import pickle
+import time
+import types
+import torch
+import torch.nn.functional as F
+import unittest
+
+import pyprof
+from pyprof.nvtx import nvmarker
+
+pushes = []
+
+
+def push(marker):
+    pushes.append(marker)
+
+
+def pop():
+    pass
+
+
+def argMarkers():
+    """
+    Returns the argument markers pushed so far as dicts.
+    """
+    return [ast.literal_eval(m.split("\n")[0]) for m in pushes]
+
+
+class TestPyProfNvtxCpu(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        # The stubs must be in place before anything is wrapped
+        nvmarker.range_push, nvmarker.range_pop = push, pop
+        for v in nvmarker.PROFILER_ENV_VARS:
+            os.environ.pop(v, None)
+
+        cls.add = torch.add
+
+        # No profiler is attached, init() does not patch anything
+        pyprof.init()
+        cls.patchedAfterInit = nvmarker.patched
+        cls.addAfterInit = torch.add
+
+        # A function wrapped after a skipped init() runs silently
+        cls.mod = types.ModuleType("dummy")
+        cls.mod.foo = lambda x: x + 1
+        pyprof.wrap(cls.mod, "foo")
+        cls.fooResult = cls.mod.foo(1)
+        cls.pushesAfterInit = len(pushes)
+
+    def setUp(self):
+        del pushes[:]
+
+    def tearDown(self):
+        nvmarker.enable()
+
+    def test_init_skips_patching(self):
+        self.assertFalse(self.patchedAfterInit)
+        self.assertIs(self.addAfterInit, self.add)
+        self.assertEqual(self.pushesAfterInit, 0)
+
+    def test_wrap_silent_until_enable(self):
+        self.assertEqual(self.fooResult, 2)
+        nvmarker.enable()
+        self.assertEqual(self.mod.foo(1), 2)
+        args = [{'name': '', 'type': 'int', 'value': 1}]
+        self.assertEqual(argMarkers(), [{'mod': 'dummy', 'op': 'foo', 'args': args}])
+
+    def test_enable_patches_once(self):
+        nvmarker.enable()
+        add = torch.add
+        self.assertIsNot(add, self.add)
+        self.assertEqual(add.__pyprof_wrapped__, ('torch', 'add'))
+        nvmarker.enable()
+        self.assertIs(torch.add, add)
+
+        torch.add(torch.ones(2), 1)
+        self.assertEqual([(m['mod'], m['op']) for m in argMarkers()], [('torch', 'ones'), ('torch', 'add')])
+
+    def test_disable_calls_through(self):
+        nvmarker.enable()
+        nvmarker.disable()
+        x = torch.add(torch.ones(2), 1)
+        self.assertEqual(x.tolist(), [2.0, 2.0])
+        self.assertEqual(pushes, [])
+
+        nvmarker.enable()
+        torch.add(x, 1)
+        self.assertEqual([m['op'] for m in argMarkers()], ['add'])
+
+    def test_metadata_ops(self):
+        nvmarker.enable()
+        x = torch.ones(1, 3, 8, 8)
+        del pushes[:]
+
+        # Tensor.unfold is a view, its marker has no arguments
+        x.unfold(2, 2, 2)
+        self.assertEqual(argMarkers(), [{'mod': 'Tensor', 'op': 'unfold', 'args': []}])
+
+        # F.unfold (im2col) launches a kernel and gets the full marker
+        del pushes[:]
+        F.unfold(x, (2, 2))
+        markers = argMarkers()
+        self.assertEqual([(m['mod'], m['op']) for m in markers][0], ('torch.nn.functional', 'unfold'))
+        tensorArg = {'name': '', 'type': 'tensor', 'shape': (1, 3, 8, 8), 'dtype': 'float32'}
+        tupleArg = {'name': '', 'type': 'tuple', 'value': (2, 2)}
+        self.assertEqual(markers[0]['args'], [tensorArg, tupleArg])
+        self.assertIn('"traceMarker": ["', pushes[0].split("\n")[2])
+
+    def test_trace_depth(self):
+        old = os.environ.pop("PYPROF_TRACE_DEPTH", None)
+        try:
+            self.assertEqual(nvmarker.traceDepth(), 16)
+            os.environ["PYPROF_TRACE_DEPTH"] = "4"
+            self.assertEqual(nvmarker.traceDepth(), 4)
+            for value in ("0", "-2", "deep"):
+                os.environ["PYPROF_TRACE_DEPTH"] = value
+                with self.assertWarns(UserWarning):
+                    self.assertEqual(nvmarker.traceDepth(), 16)
+        finally:
+            os.environ.pop("PYPROF_TRACE_DEPTH", None)
+            if old is not None:
+                os.environ["PYPROF_TRACE_DEPTH"] = old
+
+    def test_repr_marker(self):
+        nvmarker.enable()
+        pyprof.wrap(torch.nn.Linear, 'forward')
+        linear = torch.nn.Linear(3, 4)
+        x = torch.ones(2, 3)
+        del pushes[:]
+        linear(x)
+        linear(x)
+        reprMarker = "{'mod': 'Linear', 'strRepr': 'in_features=3, out_features=4, bias=True'}"
+        self.assertEqual([m.split("\n")[1] for m in pushes if "'op': 'forward'" in m], [reprMarker] * 2)
+
+        # The cached marker is not stored in the module
+        self.assertFalse(any('pyprof' in k for k in vars(linear)))
+        self.assertFalse(any('pyprof' in k for k in vars(copy.deepcopy(linear))))
+        self.assertNotIn(b'pyprof', pickle.dumps(linear))
+
+    def test_no_python_caller(self):
+        # torch.add is called from C, there is no Python frame above the wrapper
+        nvmarker.enable()
+        x = torch.ones(2)
+        del pushes[:]
+        _thread.start_new_thread(torch.add, (x, 1))
+        for _ in range(100):
+            if pushes:
+                break
+            time.sleep(0.05)
+        self.assertEqual(len(pushes), 1)
+        self.assertEqual(argMarkers()[0]['op'], 'add')
+        self.assertEqual(pushes[0].split("\n")[2], '{"traceMarker": []}')
+
+
+def run_tests():
+    dummy = TestPyProfNvtxCpu('test_init_skips_patching')
+    test_cases = list(
+        filter(lambda x: 'test_' in x, map(lambda x: x[0], inspect.getmembers(dummy, predicate=inspect.ismethod)))
+    )
+    suite = unittest.TestSuite()
+    for test_case in test_cases:
+        suite.addTest(TestPyProfNvtxCpu(test_case))
+    result = unittest.TextTestRunner(verbosity=2).run(suite)
+    if result.wasSuccessful():
+        exit(0)
+    else:
+        exit(1)
+
+
+if __name__ == '__main__':
+    run_tests()